@@ -9,77 +9,241 @@ import socket
 import struct
 import sys
 import os
+import hashlib
+import mmap
+import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+# Bytes sent in the same write as the size header
+FIRST_CHUNK_SIZE = 65536
 
-def send_multicast_command(command: str, group: str, port: int):
-    """Send a multicast UDP command."""
+# Bytes handed to each sendfile() call; progress is reported between calls
+SENDFILE_CHUNK = 1024 * 1024
+
+# Minimum seconds between progress line updates
+PROGRESS_INTERVAL = 0.25
+
+
+# Multicast send socket reused across send_multicast_command() calls,
+# along with the (interface, loopback) options it was configured for
+_MCAST_SOCK = None
+_MCAST_OPTS = None
+
+
+def _get_multicast_socket(interface: str, loopback: bool) -> socket.socket:
+    """Return the cached multicast send socket, recreating it if the options changed."""
+    global _MCAST_SOCK, _MCAST_OPTS
+    if _MCAST_SOCK is not None and _MCAST_OPTS == (interface, loopback):
+        return _MCAST_SOCK
+    
+    if _MCAST_SOCK is not None:
+        _MCAST_SOCK.close()
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loopback))
+    if interface:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    _MCAST_SOCK, _MCAST_OPTS = sock, (interface, loopback)
+    return sock
+
+
+def send_multicast_command(command: str, group: str, port: int,
+                           interface: str = None, loopback: bool = False):
+    """Send a multicast UDP command.
+    
+    Args:
+        interface: Local IP address of the interface to send from (default: OS choice)
+        loopback: If True, also deliver the command to listeners on this host
+    """
+    sock = _get_multicast_socket(interface, loopback)
     sock.sendto(command.upper().encode(), (group, port))
-    sock.close()
     print(f"Sent '{command.upper()}' to {group}:{port}")
 
 
-def send_file(filepath: str, host: str, port: int):
-    """Send a video file to the player."""
+def _recv_response(sock: socket.socket) -> str:
+    """Read one newline-terminated status line (at most 16 bytes) from the player."""
+    buf = bytearray(16)
+    mv = memoryview(buf)
+    got = 0
+    while got < len(buf) and b"\n" not in buf[:got]:
+        n = sock.recv_into(mv[got:])
+        if not n:
+            break
+        got += n
+    return buf[:got].decode().strip()
+
+
+def _send_with_header(sock: socket.socket, header: bytes, data):
+    """Send header and data in a single write where possible."""
+    if not hasattr(sock, "sendmsg"):  # Unix only
+        sock.sendall(header + data)
+        return
+    n = sock.sendmsg([header, data])
+    if n < len(header):
+        sock.sendall(header[n:])
+        n = len(header)
+    sock.sendall(data[n - len(header):])
+
+
+def _file_digest(filepath: str) -> bytes:
+    """Return the SHA-256 digest of a file, read through a memory map."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+    return digest.digest()
+
+
+def send_file(filepath: str, host: str, port: int, buffer_size: int = None,
+              concurrent: bool = False, get_digest=None):
+    """Send a video file to the player.
+    
+    Args:
+        concurrent: Other transfers are running alongside this one, so prefix
+            output with the host and skip the progress line
+        get_digest: Callable returning the file's SHA-256, so several transfers
+            can share one hash (default: hash the file here when needed)
+    """
+    if concurrent:
+        # One write per line so lines from different hosts don't run together
+        def say(msg):
+            sys.stdout.write(f"{host}: {msg}\n")
+    else:
+        say = print
+    
     if not os.path.exists(filepath):
-        print(f"Error: File not found: {filepath}")
+        say(f"Error: File not found: {filepath}")
         return False
     
     file_size = os.path.getsize(filepath)
-    print(f"Sending {filepath} ({file_size} bytes) to {host}:{port}")
+    say(f"Sending {filepath} ({file_size} bytes) to {host}:{port}")
     
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Setting SO_SNDBUF disables the kernel's buffer autotuning, so only
+        # do it when a size was asked for
+        if buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         sock.settimeout(10)
         sock.connect((host, port))
+        if hasattr(socket, "TCP_QUICKACK"):  # Linux only
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
         
-        response = sock.recv(16).decode().strip()
+        response = _recv_response(sock)
         if response == "BUSY":
-            print("Error: Player is busy (playback in progress)")
+            say("Error: Player is busy (playback in progress)")
             sock.close()
             return False
-        elif response != "READY":
-            print(f"Error: Unexpected response: {response}")
+        elif response == "READY SHA256":
+            # Only hashed once the player can use it, and inside the try so an
+            # unreadable file is reported like any other transfer error
+            digest = get_digest() if get_digest else _file_digest(filepath)
+            header = struct.pack(">Q", file_size) + digest
+        elif response == "READY":
+            # Older player: it expects only the size and can't verify the file
+            say("Player does not support checksums, sending without verification")
+            header = struct.pack(">Q", file_size)
+        else:
+            say(f"Error: Unexpected response: {response}")
             sock.close()
             return False
         
-        print("Player ready, starting transfer...")
-        sock.send(struct.pack(">Q", file_size))
+        say("Player ready, starting transfer...")
         
-        sent = 0
+        last_report = time.monotonic()
         with open(filepath, "rb") as f:
+            if file_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    
+                    # Send the size header together with the first chunk of data
+                    # so it doesn't travel in a segment of its own. The chunk is a
+                    # view of the mapping, so it is never copied into a bytes object.
+                    with memoryview(mm)[:FIRST_CHUNK_SIZE] as first_chunk:
+                        _send_with_header(sock, header, first_chunk)
+                        sent = len(first_chunk)
+            else:
+                # An empty file can't be mapped; the header alone describes it
+                sock.sendall(header)
+                sent = 0
+            
+            # socket.sendfile() uses zero-copy sendfile(2) where available and
+            # falls back to a read/send loop internally on other platforms
             while sent < file_size:
-                chunk = f.read(65536)
-                if not chunk:
+                count = sock.sendfile(f, sent, min(SENDFILE_CHUNK, file_size - sent))
+                if not count:
                     break
-                sock.sendall(chunk)
-                sent += len(chunk)
-                progress = int((sent / file_size) * 100)
-                print(f"\rProgress: {progress}%", end="", flush=True)
+                sent += count
+                if concurrent:
+                    continue
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL or sent == file_size:
+                    last_report = now
+                    progress = int((sent / file_size) * 100)
+                    print(f"\rProgress: {progress}%", end="", flush=True)
         
-        print()
+        if not concurrent:
+            print()
         sock.settimeout(30)
-        response = sock.recv(16).decode().strip()
+        response = _recv_response(sock)
         
         if response == "OK":
-            print("File transferred successfully")
+            say("File transferred successfully")
             return True
+        elif response == "BADHASH":
+            say("Transfer failed: checksum mismatch")
+            return False
         else:
-            print(f"Transfer failed: {response}")
+            say(f"Transfer failed: {response}")
             return False
             
     except socket.timeout:
-        print("Error: Connection timeout")
+        say("Error: Connection timeout")
         return False
     except Exception as e:
-        print(f"Error: {e}")
+        say(f"Error: {e}")
         return False
     finally:
         sock.close()
 
 
+def send_file_multi(filepath: str, hosts: list, port: int,
+                    buffer_size: int = None):
+    """Send a video file to several players concurrently."""
+    if not os.path.exists(filepath):
+        print(f"Error: File not found: {filepath}")
+        return False
+    
+    # Hash at most once for all hosts, and only if a player asks for it
+    digest_lock = threading.Lock()
+    digests = []
+    
+    def get_digest():
+        with digest_lock:
+            if not digests:
+                digests.append(_file_digest(filepath))
+            return digests[0]
+    
+    hosts = list(dict.fromkeys(hosts))  # One transfer per host, in the order given
+    with ThreadPoolExecutor(max_workers=len(hosts)) as pool:
+        futures = {
+            host: pool.submit(send_file, filepath, host, port, buffer_size,
+                              concurrent=True, get_digest=get_digest)
+            for host in hosts
+        }
+    
+    results = {host: future.result() for host, future in futures.items()}
+    for host, success in results.items():
+        print(f"{host}: {'OK' if success else 'FAILED'}")
+    return all(results.values())
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Control Raspberry Pi Video Player",
@@ -91,6 +255,7 @@ Examples:
   %(prog)s load                          # Preload video (paused)
   %(prog)s go                            # Start preloaded video
   %(prog)s send video.mp4 192.168.1.100  # Send video file to specific Pi
+  %(prog)s send video.mp4 pi1 pi2 pi3    # Send video file to several Pis at once
 
 For synchronized playback across multiple Pis:
   %(prog)s load                          # All Pis load and pause
@@ -103,19 +268,30 @@ For synchronized playback across multiple Pis:
     parser.add_argument("args", nargs="*", help="Additional arguments")
     parser.add_argument("-g", "--group", default="239.255.42.1",
                         help="Multicast group (default: 239.255.42.1)")
+    parser.add_argument("-i", "--interface",
+                        help="Local IP address of the interface to send multicast from")
+    parser.add_argument("--loopback", action="store_true",
+                        help="Also deliver multicast commands to a player on this host")
     parser.add_argument("-p", "--port", type=int, default=5000,
                         help="Port (default: 5000 for commands, 5001 for file transfer)")
+    parser.add_argument("-b", "--buffer-size", type=int,
+                        help="Socket send buffer for file transfer in bytes (default: kernel autotuning)")
     
     args = parser.parse_args()
     
     if args.command in ["play", "stop", "load", "go"]:
-        send_multicast_command(args.command, args.group, args.port)
+        send_multicast_command(args.command, args.group, args.port,
+                               args.interface, args.loopback)
     elif args.command == "send":
         if len(args.args) < 2:
-            print("Usage: send <file> <host> [-p port]")
+            print("Usage: send <file> <host> [host ...] [-p port]")
             sys.exit(1)
         port = args.port if args.port != 5000 else 5001
-        success = send_file(args.args[0], args.args[1], port)
+        filepath, hosts = args.args[0], args.args[1:]
+        if len(hosts) == 1:
+            success = send_file(filepath, hosts[0], port, args.buffer_size)
+        else:
+            success = send_file_multi(filepath, hosts, port, args.buffer_size)
         sys.exit(0 if success else 1)
 
 
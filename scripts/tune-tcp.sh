@@ -0,0 +1,10 @@
+#!/bin/sh
+# TCP tuning for video file transfers. Run as root before the player starts
+# (video-player.service does this via ExecStartPre).
+#
+# - tcp_slow_start_after_idle=0: keep the congestion window between pushes
+#   instead of restarting slow-start on every new transfer
+# - tcp_notsent_lowat=131072: limit unsent data queued in the socket so the
+#   large send buffers don't add latency
+
+sysctl -w net.ipv4.tcp_slow_start_after_idle=0 net.ipv4.tcp_notsent_lowat=131072
@@ -6,6 +6,8 @@ Video Player for Original Raspberry Pi (omxplayer)
 - Receives replacement video files over TCP (when not playing)
 """
 
+import hashlib
+import selectors
 import socket
 import struct
 import subprocess
@@ -14,6 +16,8 @@ import os
 import sys
 import signal
 import logging
+import logging.handlers
+import atexit
 import time
 
 # Configuration
@@ -24,21 +28,117 @@ CONFIG = {
     "multicast_port": 5000,
     "file_transfer_port": 5001,
     "audio_output": "hdmi",
+    "socket_buffer_size": None,  # None: let the kernel autotune
 }
 
+# Chunk size for the file transfer receive loop and its write buffer
+RECV_BUFFER_SIZE = 1024 * 1024
+
+# File transfer header: 8-byte size + 32-byte SHA-256 digest
+HEADER_SIZE = 8 + 32
+
+
+class BufferedLogHandler(logging.handlers.MemoryHandler):
+    """Collects log records and writes them to the target stream in one go.
+    
+    Records are written when the buffer is full, a record at flushLevel or
+    above arrives, or FLUSH_INTERVAL has passed since the last write.
+    """
+    
+    FLUSH_INTERVAL = 1.0
+    
+    def __init__(self, capacity: int, flushLevel: int, target: logging.StreamHandler):
+        super().__init__(capacity, flushLevel, target)
+        self._last_flush = time.monotonic()
+    
+    def shouldFlush(self, record) -> bool:
+        return (super().shouldFlush(record)
+                or time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL)
+    
+    def flush(self):
+        with self.lock:
+            if self.target is not None and self.buffer:
+                # Like Handler.emit(), report failures via handleError() rather
+                # than raising into the code that made the logging call
+                lines = []
+                for record in self.buffer:
+                    try:
+                        lines.append(self.format(record) + "\n")
+                    except Exception:
+                        self.handleError(record)
+                try:
+                    stream = self.target.stream
+                    stream.write("".join(lines))
+                    stream.flush()
+                except Exception:
+                    self.handleError(self.buffer[-1])
+                self.buffer.clear()
+            self._last_flush = time.monotonic()
+
+
 # Logging setup
+log_handler = BufferedLogHandler(
+    capacity=64,
+    flushLevel=logging.WARNING,
+    target=logging.StreamHandler(sys.stdout),
+)
+atexit.register(log_handler.flush)
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
+    handlers=[log_handler],
 )
 logger = logging.getLogger(__name__)
 
 
+def _recv_exact(conn: socket.socket, n: int, buf: bytearray) -> int:
+    """Fill buf[:n] from conn, however the data is split across segments.
+    
+    Returns n, or 0 if the peer closed the connection first.
+    """
+    mv = memoryview(buf)
+    got = 0
+    while got < n:
+        r = conn.recv_into(mv[got:n])
+        if not r:
+            return 0
+        got += r
+    return got
+
+
+class _WakePipe:
+    """Self-pipe that wakes a thread blocked in a selector.
+    
+    Created per start() run and closed when it returns, so a later
+    start() doesn't see a stale wake byte.
+    """
+    
+    def __init__(self):
+        self.fd, self._write_fd = os.pipe()
+        self._lock = threading.Lock()
+    
+    def wake(self):
+        with self._lock:
+            if self._write_fd is not None:
+                os.write(self._write_fd, b"\0")
+    
+    def close(self):
+        # The lock keeps wake() from writing to a closed, possibly reused, fd
+        with self._lock:
+            os.close(self.fd)
+            os.close(self._write_fd)
+            self._write_fd = None
+
+
 class VideoPlayer:
     """Manages omxplayer subprocess using FIFO for control."""
 
     FIFO_PATH = "/tmp/omxplayer_fifo"
+    POLL_CACHE_TTL = 0.05  # Seconds to reuse a "still running" poll result
+    # omxplayer's launcher keeps a session bus running and stores its address here
+    DBUS_ADDRESS_PATH = f"/tmp/omxplayerdbus.{os.environ.get('USER') or 'root'}"
+    DBUS_NAME = "org.mpris.MediaPlayer2.omxplayer"
+    STARTUP_TIMEOUT = 1.0
 
     def __init__(self, video_path: str, audio_output: str = "hdmi"):
         self.video_path = video_path
@@ -47,6 +147,8 @@ class VideoPlayer:
         self.fifo_fd = None
         self._paused = False
         self._lock = threading.Lock()
+        self._last_poll_time = 0.0
+        self._last_poll_alive = False
         self._setup_fifo()
 
     def _setup_fifo(self):
@@ -55,15 +157,55 @@ class VideoPlayer:
             os.remove(self.FIFO_PATH)
         os.mkfifo(self.FIFO_PATH)
 
-    def _send_command(self, cmd: bytes) -> bool:
-        """Send a command to omxplayer via FIFO."""
+    def _on_dbus(self, timeout: float) -> bool:
+        """Check whether omxplayer has claimed its D-Bus name.
+        
+        omxplayer turns FIFO key presses into D-Bus calls to that name, so a
+        key read before the name exists is dropped.
+        """
         try:
-            if self.fifo_fd is not None:
-                os.write(self.fifo_fd, cmd)
-                return True
-        except Exception as e:
-            logger.error(f"Failed to send command: {e}")
-        return False
+            with open(self.DBUS_ADDRESS_PATH) as f:
+                address = f.read().strip()
+            result = subprocess.run(
+                ["dbus-send", f"--bus={address}", "--print-reply",
+                 "--dest=org.freedesktop.DBus", "/org/freedesktop/DBus",
+                 "org.freedesktop.DBus.NameHasOwner", f"string:{self.DBUS_NAME}"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=timeout,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return b"boolean true" in result.stdout
+
+    def _wait_for_startup(self):
+        """Wait until omxplayer is on D-Bus, up to STARTUP_TIMEOUT."""
+        deadline = time.monotonic() + self.STARTUP_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.process.poll() is not None:
+                logger.warning("omxplayer not ready on D-Bus, pausing anyway")
+                return
+            if self._on_dbus(remaining):
+                return
+            time.sleep(0.01)
+
+    def _close_fifo(self):
+        """Close our write end of the FIFO."""
+        if self.fifo_fd is not None:
+            try:
+                os.close(self.fifo_fd)
+            except OSError:
+                pass
+            self.fifo_fd = None
+
+    def _send_command(self, cmd: bytes) -> bool:
+        """Send a command to omxplayer via FIFO.
+        
+        Kept minimal as it sits on the GO latency path; callers handle OSError.
+        """
+        fd = self.fifo_fd
+        return fd is not None and os.write(fd, cmd) == len(cmd)
 
     def play(self, paused: bool = False) -> bool:
         """Start video playback.
@@ -94,25 +236,32 @@ class VideoPlayer:
                 
                 logger.info(f"Starting: {' '.join(cmd)}")
                 
-                # Open FIFO for writing (non-blocking open, then we have the fd)
-                fifo_read = open(self.FIFO_PATH, 'r+b', buffering=0)
-                self.fifo_fd = fifo_read.fileno()
-                
-                self.process = subprocess.Popen(
-                    cmd,
-                    stdin=fifo_read,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    preexec_fn=os.setsid,
-                )
+                # Our end is opened read/write so the open doesn't wait for a
+                # reader, and non-blocking so a command can never stall us.
+                # omxplayer gets its own blocking read end as stdin.
+                self.fifo_fd = os.open(self.FIFO_PATH, os.O_RDWR | os.O_NONBLOCK)
+                fifo_read = os.open(self.FIFO_PATH, os.O_RDONLY)
+                try:
+                    self.process = subprocess.Popen(
+                        cmd,
+                        stdin=fifo_read,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        preexec_fn=os.setsid,
+                    )
+                finally:
+                    os.close(fifo_read)
                 
-                self._fifo_file = fifo_read  # Keep reference to prevent GC
                 self._paused = False
+                self._last_poll_alive = False
                 
-                # If paused mode requested, wait for video to start then pause
+                # If paused mode requested, wait for omxplayer to be ready then pause
                 if paused:
-                    time.sleep(0.5)  # Wait for omxplayer to initialize
-                    self._send_command(b"p")
+                    self._wait_for_startup()
+                    try:
+                        self._send_command(b"p")
+                    except OSError as e:
+                        logger.error(f"Failed to send command: {e}")
                     self._paused = True
                     logger.info("Video loaded and paused")
                 
@@ -120,7 +269,7 @@ class VideoPlayer:
             except Exception as e:
                 logger.error(f"Failed to start omxplayer: {e}")
                 self.process = None
-                self.fifo_fd = None
+                self._close_fifo()
                 return False
 
     def preload(self) -> bool:
@@ -138,7 +287,12 @@ class VideoPlayer:
                 logger.warning("Video not in paused state")
                 return False
 
-        if self._send_command(b"p"):
+        try:
+            sent = self._send_command(b"p")
+        except OSError as e:
+            logger.error(f"Failed to send command: {e}")
+            return False
+        if sent:
             self._paused = False
             logger.info("Playback started")
             return True
@@ -151,7 +305,10 @@ class VideoPlayer:
                 return False
 
             try:
-                self._send_command(b"q")
+                try:
+                    self._send_command(b"q")
+                except OSError as e:
+                    logger.error(f"Failed to send command: {e}")
                 
                 try:
                     self.process.wait(timeout=2)
@@ -163,34 +320,39 @@ class VideoPlayer:
             except Exception as e:
                 logger.error(f"Error stopping playback: {e}")
             finally:
-                if hasattr(self, '_fifo_file'):
-                    try:
-                        self._fifo_file.close()
-                    except:
-                        pass
+                self._close_fifo()
                 self.process = None
-                self.fifo_fd = None
                 self._paused = False
+                self._last_poll_alive = False
             return True
 
     def is_playing(self) -> bool:
-        """Check if video is currently playing or loaded."""
+        """Check if video is currently playing or loaded.
+        
+        The common case is answered without taking the lock; it is only
+        needed to clean up after a process that has exited.
+        """
+        process = self.process
+        if process is None:
+            return False
+        
+        # Avoid a waitpid() per call when commands arrive in quick succession
+        now = time.monotonic()
+        if self._last_poll_alive and now - self._last_poll_time < self.POLL_CACHE_TTL:
+            return True
+        
+        if process.poll() is None:
+            self._last_poll_time = now
+            self._last_poll_alive = True
+            return True
+        
         with self._lock:
-            if self.process is None:
-                return False
-            
-            poll = self.process.poll()
-            if poll is not None:
-                if hasattr(self, '_fifo_file'):
-                    try:
-                        self._fifo_file.close()
-                    except:
-                        pass
+            if self.process is process:
+                self._close_fifo()
                 self.process = None
-                self.fifo_fd = None
                 self._paused = False
-                return False
-            return True
+                self._last_poll_alive = False
+        return False
 
 
 class MulticastListener:
@@ -201,6 +363,7 @@ class MulticastListener:
         self.port = port
         self.socket = None
         self._running = False
+        self._wake = None
 
     def start(self, callback):
         """Start listening for multicast messages."""
@@ -210,24 +373,34 @@ class MulticastListener:
         
         mreq = struct.pack("4sl", socket.inet_aton(self.group), socket.INADDR_ANY)
         self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        self.socket.settimeout(1.0)
+        
+        # Block until a packet arrives or stop() writes to the wake pipe
+        self._wake = _WakePipe()
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self._wake.fd, selectors.EVENT_READ)
         self._running = True
         
         logger.info(f"Listening for multicast on {self.group}:{self.port}")
         
         while self._running:
             try:
+                if not any(key.fileobj is self.socket for key, _ in selector.select()):
+                    continue
                 data, addr = self.socket.recvfrom(1024)
                 logger.debug(f"Received from {addr}: {data}")
                 callback(data, addr)
-            except socket.timeout:
-                continue
             except Exception as e:
                 if self._running:
                     logger.error(f"Multicast receive error: {e}")
+        
+        selector.close()
+        self._wake.close()
 
     def stop(self):
         self._running = False
+        if self._wake:
+            self._wake.wake()
         if self.socket:
             self.socket.close()
 
@@ -235,32 +408,47 @@ class MulticastListener:
 class FileReceiver:
     """TCP server for receiving video files."""
 
-    def __init__(self, port: int, dest_path: str, temp_path: str):
+    def __init__(self, port: int, dest_path: str, temp_path: str,
+                 buffer_size: int = CONFIG["socket_buffer_size"]):
         self.port = port
         self.dest_path = dest_path
         self.temp_path = temp_path
+        self.buffer_size = buffer_size
         self.socket = None
         self._running = False
-        self._receiving = False
-        self._lock = threading.Lock()
+        self._receiving = False  # Only written by the receiver thread
+        self._wake = None
 
     def is_receiving(self) -> bool:
-        with self._lock:
-            return self._receiving
+        return self._receiving
 
     def start(self, can_receive_callback):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Setting SO_RCVBUF disables autotuning, so only do it when asked. It
+        # must happen before listen(): accepted connections inherit it and
+        # the window scale is fixed in the SYN.
+        if self.buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.buffer_size)
         self.socket.bind(("", self.port))
         self.socket.listen(1)
-        self.socket.settimeout(1.0)
+        
+        # Block until a connection arrives or stop() writes to the wake pipe
+        self._wake = _WakePipe()
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self._wake.fd, selectors.EVENT_READ)
         self._running = True
         
         logger.info(f"File receiver listening on port {self.port}")
         
         while self._running:
             try:
+                if not any(key.fileobj is self.socket for key, _ in selector.select()):
+                    continue
                 conn, addr = self.socket.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
                 
                 if not can_receive_callback():
                     logger.warning(f"Rejecting file transfer from {addr} - playback in progress")
@@ -269,44 +457,77 @@ class FileReceiver:
                     continue
                 
                 logger.info(f"Accepting file transfer from {addr}")
-                conn.send(b"READY\n")
+                # Advertise the size + SHA-256 header so older clients, which
+                # only send the size, refuse instead of corrupting the file
+                conn.send(b"READY SHA256\n")
                 self._receive_file(conn, addr)
                 
-            except socket.timeout:
-                continue
             except Exception as e:
                 if self._running:
                     logger.error(f"File receiver error: {e}")
+        
+        selector.close()
+        self._wake.close()
 
     def _receive_file(self, conn: socket.socket, addr):
-        with self._lock:
-            self._receiving = True
+        self._receiving = True
         
         try:
-            size_data = conn.recv(8)
-            if len(size_data) != 8:
-                logger.error("Failed to receive file size")
+            # Header: file size (big-endian uint64) + SHA-256 digest of the file
+            header = bytearray(HEADER_SIZE)
+            if not _recv_exact(conn, HEADER_SIZE, header):
+                logger.error("Failed to receive file header")
                 conn.send(b"ERROR\n")
                 return
             
-            file_size = struct.unpack(">Q", size_data)[0]
+            file_size = struct.unpack(">Q", header[:8])[0]
+            expected_digest = bytes(header[8:])
             logger.info(f"Receiving file of {file_size} bytes")
             
             os.makedirs(os.path.dirname(self.temp_path), exist_ok=True)
             
-            received = 0
-            with open(self.temp_path, "wb") as f:
+            # Receive into one reusable buffer instead of allocating per chunk
+            buf = bytearray(RECV_BUFFER_SIZE)
+            mv = memoryview(buf)
+            fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            with os.fdopen(fd, "wb", buffering=RECV_BUFFER_SIZE) as f:
+                # Reserve the space up front so the SD card file isn't extended piecemeal
+                try:
+                    os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                    pass  # Not supported by every filesystem
+                os.posix_fadvise(fd, 0, file_size, os.POSIX_FADV_SEQUENTIAL)
+                
+                # Hash while receiving so verification needs no second pass
+                # over the SD card
+                digest = hashlib.sha256()
+                received = 0
                 while received < file_size:
-                    chunk = conn.recv(min(65536, file_size - received))
-                    if not chunk:
+                    n = conn.recv_into(mv[:min(len(buf), file_size - received)])
+                    if not n:
                         break
+                    chunk = mv[:n]
                     f.write(chunk)
-                    received += len(chunk)
+                    digest.update(chunk)
+                    received += n
+                
+                complete = received == file_size
+                verified = complete and digest.digest() == expected_digest
+                if verified:
+                    # Only clean pages can be dropped, so sync before evicting
+                    # the new file from the page cache
+                    f.flush()
+                    os.fdatasync(fd)
+                    os.posix_fadvise(fd, 0, file_size, os.POSIX_FADV_DONTNEED)
             
-            if received == file_size:
+            if verified:
                 os.replace(self.temp_path, self.dest_path)
                 logger.info(f"File received successfully: {self.dest_path}")
                 conn.send(b"OK\n")
+            elif complete:
+                logger.error("Checksum mismatch, discarding received file")
+                os.remove(self.temp_path)
+                conn.send(b"BADHASH\n")
             else:
                 logger.error(f"Incomplete transfer: {received}/{file_size}")
                 conn.send(b"ERROR\n")
@@ -319,12 +540,13 @@ class FileReceiver:
             if os.path.exists(self.temp_path):
                 os.remove(self.temp_path)
         finally:
-            with self._lock:
-                self._receiving = False
+            self._receiving = False
             conn.close()
 
     def stop(self):
         self._running = False
+        if self._wake:
+            self._wake.wake()
         if self.socket:
             self.socket.close()
 
@@ -339,46 +561,55 @@ class VideoPlayerController:
         self.file_receiver = FileReceiver(
             config["file_transfer_port"],
             config["video_file"],
-            config["temp_video_file"]
+            config["temp_video_file"],
+            config["socket_buffer_size"],
         )
         self._running = False
         self._threads = []
+        self._handlers = {
+            b"PLAY": self._on_play,
+            b"STOP": self.player.stop,
+            b"LOAD": self._on_load,
+            b"GO": self.player.go,
+        }
 
     def _handle_command(self, data: bytes, addr):
         command = data.strip().upper()
-        
-        if command == b"PLAY":
-            if self.file_receiver.is_receiving():
-                logger.warning("Cannot play - file transfer in progress")
-                return
-            if not self.player.is_playing():
-                self.player.play()
-            else:
-                logger.info("Already playing")
-                
-        elif command == b"STOP":
-            self.player.stop()
-        
-        elif command == b"LOAD":
-            if self.file_receiver.is_receiving():
-                logger.warning("Cannot load - file transfer in progress")
-                return
-            if not self.player.is_playing():
-                self.player.preload()
-            else:
-                logger.info("Already playing/loaded")
-        
-        elif command == b"GO":
-            self.player.go()
-            
-        else:
+        handler = self._handlers.get(command)
+        if handler is None:
             logger.debug(f"Unknown command: {command}")
+            return
+        handler()
+
+    def _on_play(self):
+        if self.file_receiver.is_receiving():
+            logger.warning("Cannot play - file transfer in progress")
+            return
+        if not self.player.is_playing():
+            self.player.play()
+        else:
+            logger.info("Already playing")
+
+    def _on_load(self):
+        if self.file_receiver.is_receiving():
+            logger.warning("Cannot load - file transfer in progress")
+            return
+        if not self.player.is_playing():
+            self.player.preload()
+        else:
+            logger.info("Already playing/loaded")
 
     def _can_receive_file(self) -> bool:
         return not self.player.is_playing()
 
+    def _handle_sigterm(self, signum, frame):
+        """Leave the main loop so stop() runs and atexit flushes the log."""
+        logger.info("Shutdown requested")
+        self._running = False
+
     def start(self):
         self._running = True
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
         
         logger.info("Starting Video Player Controller")
         logger.info(f"Video file: {self.config['video_file']}")
@@ -404,6 +635,7 @@ class VideoPlayerController:
         try:
             while self._running:
                 time.sleep(1)
+                log_handler.flush()  # Don't let quiet periods hold back buffered lines
         except KeyboardInterrupt:
             logger.info("Shutdown requested")
         
@@ -429,6 +661,9 @@ def main():
                         help="Multicast port")
     parser.add_argument("--transfer-port", type=int, default=CONFIG["file_transfer_port"],
                         help="File transfer port")
+    parser.add_argument("--socket-buffer", type=int, default=CONFIG["socket_buffer_size"],
+                        help="Receive buffer size for file transfers in bytes "
+                             "(default: kernel autotuning)")
     parser.add_argument("--audio", default="hdmi", choices=["hdmi", "local", "both"],
                         help="Audio output")
     parser.add_argument("-v", "--verbose", action="store_true",
@@ -446,6 +681,7 @@ def main():
     config["multicast_port"] = args.multicast_port
     config["file_transfer_port"] = args.transfer_port
     config["audio_output"] = args.audio
+    config["socket_buffer_size"] = args.socket_buffer
     
     os.makedirs(os.path.dirname(config["video_file"]), exist_ok=True)
     